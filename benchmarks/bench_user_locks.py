@@ -0,0 +1,35 @@
+"""Contention benchmark for `UserLockManager`: one hot user vs. many distinct users.
+
+Run from the repository root: python benchmarks/bench_user_locks.py
+"""
+import asyncio, gc, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp()) # main.py creates its SQLite file in the working directory on import.
+from main import UserLockManager
+
+OPERATIONS = 10000
+HOLD_SECONDS = 0.001
+
+
+async def run(locks: UserLockManager, users: int, two_party: bool) -> float:
+    async def operation(i: int):
+        ids = (i % users, (i + 1) % users) if two_party else (i % users,)
+        async with locks.hold(*ids): await asyncio.sleep(HOLD_SECONDS)
+    started = time.perf_counter()
+    await asyncio.gather(*[operation(i) for i in range(OPERATIONS)])
+    return time.perf_counter() - started
+
+
+async def main():
+    locks = UserLockManager()
+    print(f"{OPERATIONS} operations, each holding its lock(s) for {HOLD_SECONDS * 1000:.0f}ms")
+    for label, users, two_party in (("same user", 1, False), ("10 hot users", 10, False), ("distinct users", OPERATIONS, False), ("two-party, 10 users", 10, True), ("two-party, distinct", OPERATIONS, True)):
+        elapsed = await run(locks, users, two_party)
+        print(f"{label:<22} {elapsed:7.3f}s  {OPERATIONS / elapsed:10.0f} ops/s")
+    gc.collect()
+    print(f"locks left after run: {len(locks.locks)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,23 +1,26 @@
-import logging, json, uvicorn, os, base64, random, asyncio
+import logging, json, uvicorn, os, base64, random, asyncio, hashlib, time, weakref
 from io import BytesIO
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
-from datetime import date, timedelta
-from typing import Dict, List, Optional
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 
 # Core Frameworks
 from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 
 # Telegram Bot Library
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+from telegram.error import BadRequest
 from telegram.ext import (
     Application, CommandHandler, ContextTypes, ConversationHandler,
     MessageHandler, filters, CallbackQueryHandler
 )
 
 # Database
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Float, ForeignKey, Text, Date, Boolean
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Float, ForeignKey, Text, Date, Boolean, func, text
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
 
 # --- Configuration & Logging ---
@@ -44,6 +47,21 @@ GIFT_MAX_AMOUNT = 80000.0
 GIFT_FEE_PERCENT = 0.05
 GAME_FEE_PERCENT = 0.10
 MIN_GAME_BET = 10.0
+LEADERBOARD_SIZE = 10
+LEADERBOARD_REFRESH_SECONDS = 300
+REFERRAL_LIST_LIMIT = 100
+IDEMPOTENT_PATHS = {"/submit_withdrawal", "/gift_money", "/buy_ticket", "/create_game_room", "/submit_task_proof"}
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_MAX_KEYS = 10000
+IDEMPOTENCY_WAIT_SECONDS = 30.0
+ADMISSION_DEFAULTS = {"read": {"limit": 32, "queue": 256, "deadline": 5.0}, "write": {"limit": 8, "queue": 64, "deadline": 3.0}, "upload": {"limit": 2, "queue": 16, "deadline": 10.0}}
+ADMISSION_ENDPOINT_CLASSES = {
+    "/get_initial_data": "read", "/get_referral_info": "read", "/leaderboards": "read", "/submit_task_proof": "upload",
+    "/redeem_code": "write", "/claim_daily_bonus": "write", "/submit_withdrawal": "write", "/buy_ticket": "write",
+    "/gift_money": "write", "/create_game_room": "write", "/join_game_room": "write"
+}
+ADMISSION_TUNING_STEPS = {"limit": 1, "queue": 8, "deadline": 1.0}
+ADMISSION_TUNING_MINIMUMS = {"limit": 1, "queue": 0, "deadline": 0.5}
 
 # --- Database Setup (SAFE & STABLE) ---
 SQLALCHEMY_DATABASE_URL = "sqlite:///./gtask_data.db?check_same_thread=False"
@@ -52,7 +70,7 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 # --- Database Models ---
-class User(Base): __tablename__ = "users"; id = Column(BigInteger, primary_key=True, index=True, autoincrement=False); first_name = Column(String); balance = Column(Float, default=0.0); gift_tickets = Column(Integer, default=0); referral_count = Column(Integer, default=0); successful_referrals = Column(Integer, default=0); tasks_completed = Column(Integer, default=0); completed_task_ids = Column(Text, default="[]"); referrer_id = Column(BigInteger, ForeignKey("users.id"), nullable=True); status = Column(String, default="active"); status_until = Column(Date, nullable=True); last_login_date = Column(Date, nullable=True); daily_claim_invites = Column(Integer, default=0); claimed_milestones = Column(Text, default="{}")
+class User(Base): __tablename__ = "users"; id = Column(BigInteger, primary_key=True, index=True, autoincrement=False); first_name = Column(String); balance = Column(Float, default=0.0); gift_tickets = Column(Integer, default=0); referral_count = Column(Integer, default=0); successful_referrals = Column(Integer, default=0); tasks_completed = Column(Integer, default=0); completed_task_ids = Column(Text, default="[]"); referrer_id = Column(BigInteger, ForeignKey("users.id"), nullable=True, index=True); status = Column(String, default="active"); status_until = Column(Date, nullable=True); last_login_date = Column(Date, nullable=True); daily_claim_invites = Column(Integer, default=0); claimed_milestones = Column(Text, default="{}")
 class Task(Base): __tablename__ = "tasks"; id = Column(Integer, primary_key=True, index=True); description = Column(String); link = Column(String); reward = Column(Float); is_active = Column(Boolean, default=True)
 class TaskSubmission(Base): __tablename__ = "task_submissions"; id = Column(Integer, primary_key=True, index=True); user_id = Column(BigInteger, index=True); task_id = Column(Integer); text_proof = Column(Text, nullable=True); photo_proof_base64 = Column(Text); status = Column(String, default="pending"); created_at = Column(Date, default=date.today)
 class Withdrawal(Base): __tablename__ = "withdrawals"; id = Column(Integer, primary_key=True, index=True); user_id = Column(BigInteger, index=True); amount = Column(Float); fee = Column(Float); method = Column(String); details = Column(String); status = Column(String, default="pending"); created_at = Column(Date, default=date.today)
@@ -96,8 +114,192 @@ class ConnectionManager:
             for connection in self.active_connections[room_id]: await connection.send_text(message)
 manager = ConnectionManager()
 
+# --- Referral Graph & Leaderboards ---
+class ReferralGraph:
+    """In-memory adjacency cache of the `referrer_id` tree with per-user downline sizes (all levels)."""
+    def __init__(self):
+        self.parent: Dict[int, int] = {}
+        self.children: Dict[int, set] = {}
+        self.downline_size: Dict[int, int] = {}
+    def load(self, db: Session):
+        self.parent.clear(); self.children.clear(); self.downline_size.clear()
+        for user_id, referrer_id in db.query(User.id, User.referrer_id).filter(User.referrer_id != None).all(): self.add_user(user_id, referrer_id)
+    def add_user(self, user_id: int, referrer_id: Optional[int]):
+        if referrer_id is None or user_id in self.parent: return
+        self.parent[user_id] = referrer_id
+        self.children.setdefault(referrer_id, set()).add(user_id)
+        # Users may be loaded before their own referrer, so carry over any downline already attached to them.
+        gained, ancestor, seen = 1 + self.downline_size.get(user_id, 0), referrer_id, {user_id}
+        while ancestor is not None and ancestor not in seen:
+            seen.add(ancestor)
+            self.downline_size[ancestor] = self.downline_size.get(ancestor, 0) + gained
+            ancestor = self.parent.get(ancestor)
+    def recruits(self, user_id: int) -> List[int]: return sorted(self.children.get(user_id, ()))
+    def downline(self, user_id: int) -> int: return self.downline_size.get(user_id, 0)
+
+class Leaderboards:
+    """Top-N boards, fully rebuilt on a timer and nudged incrementally when a tracked counter changes."""
+    BOARDS = ("referrals", "tasks", "winnings")
+    def __init__(self, size: int):
+        self.size = size
+        self.boards: Dict[str, List[dict]] = {board: [] for board in self.BOARDS}
+        self.ranks: Dict[str, Dict[int, int]] = {board: {} for board in self.BOARDS}
+        self.refreshed_at: Optional[datetime] = None
+    def _set(self, board: str, rows: List[dict]):
+        rows = sorted(rows, key=lambda r: r["value"], reverse=True)[:self.size]
+        self.boards[board] = rows
+        self.ranks[board] = {r["user_id"]: i + 1 for i, r in enumerate(rows)}
+    def bump(self, board: str, user_id: int, first_name: str, value: float):
+        rows = [r for r in self.boards[board] if r["user_id"] != user_id]
+        if len(rows) < self.size or value > rows[-1]["value"]: rows.append({"user_id": user_id, "first_name": first_name, "value": value})
+        self._set(board, rows)
+    def _winnings(self, db: Session):
+        # Default wins after an opponent disconnects are paid out too, but leave the room 'cancelled'.
+        prize_total = (func.sum(GameRoom.bet_amount) * 2 * (1 - GAME_FEE_PERCENT)).label("winnings")
+        won_games = db.query(GameRoom.winner_id, prize_total).filter(GameRoom.status.in_(('finished', 'cancelled')), GameRoom.winner_id > 0).group_by(GameRoom.winner_id)
+        return prize_total, won_games
+    def bump_winnings(self, db: Session, user_id: int):
+        won = self._winnings(db)[1].filter(GameRoom.winner_id == user_id).first()
+        if won: self.bump("winnings", user_id, db.query(User.first_name).filter(User.id == user_id).scalar(), round(won[1], 2))
+    def refresh(self, db: Session):
+        referrals = db.query(User.id, User.first_name, User.referral_count).filter(User.referral_count > 0).order_by(User.referral_count.desc()).limit(self.size).all()
+        tasks = db.query(User.id, User.first_name, User.tasks_completed).filter(User.tasks_completed > 0).order_by(User.tasks_completed.desc()).limit(self.size).all()
+        prize_total, won_games = self._winnings(db)
+        winnings = won_games.order_by(prize_total.desc()).limit(self.size).all()
+        names = dict(db.query(User.id, User.first_name).filter(User.id.in_([w[0] for w in winnings])).all()) if winnings else {}
+        self._set("referrals", [{"user_id": u, "first_name": n, "value": v} for u, n, v in referrals])
+        self._set("tasks", [{"user_id": u, "first_name": n, "value": v} for u, n, v in tasks])
+        self._set("winnings", [{"user_id": u, "first_name": names.get(u), "value": round(v, 2)} for u, v in winnings])
+        self.refreshed_at = datetime.utcnow()
+    def rank(self, board: str, user_id: int) -> Optional[int]: return self.ranks[board].get(user_id)
+    def snapshot(self) -> dict:
+        return {"refreshed_at": self.refreshed_at.isoformat() if self.refreshed_at else None, **self.boards}
+referral_graph = ReferralGraph()
+leaderboards = Leaderboards(LEADERBOARD_SIZE)
+
+async def refresh_leaderboards_periodically():
+    while True:
+        try:
+            with SessionLocal() as db: leaderboards.refresh(db)
+        except Exception as e: logger.error(f"Failed to refresh leaderboards: {e}")
+        await asyncio.sleep(LEADERBOARD_REFRESH_SECONDS)
+
+# --- Idempotency Store ---
+class IdempotencyStore:
+    """`Idempotency-Key` -> response cache with TTL eviction, holding at most `max_keys` keys (in flight plus stored)."""
+    def __init__(self, max_keys: int, ttl: float):
+        self.max_keys = max_keys; self.ttl = ttl
+        self.in_flight: Dict[str, Tuple[str, asyncio.Future]] = {}
+        # Stored in completion order with a fixed TTL, so the oldest entry is always the first to expire.
+        self.stored: "OrderedDict[str, Tuple[float, str, tuple]]" = OrderedDict()
+    def _evict(self):
+        now = time.monotonic()
+        while self.stored and next(iter(self.stored.values()))[0] <= now: self.stored.popitem(last=False)
+    def begin(self, key: str, body_hash: str) -> Tuple[bool, asyncio.Future]:
+        """Returns (is_owner, future). Raises 422 if the key was used for a different request body, 429 if the store is full of in-flight keys."""
+        self._evict()
+        if key in self.in_flight: seen_hash, future = self.in_flight[key]
+        elif key in self.stored:
+            _, seen_hash, result = self.stored[key]
+            future = asyncio.get_running_loop().create_future(); future.set_result(result)
+        else: seen_hash = None
+        if seen_hash is not None:
+            if seen_hash != body_hash: raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request.")
+            return False, future
+        if len(self.in_flight) + len(self.stored) >= self.max_keys:
+            if not self.stored: raise HTTPException(status_code=429, detail="Too many requests in flight. Please retry shortly.", headers={"Retry-After": "1"})
+            self.stored.popitem(last=False)
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = (body_hash, future)
+        return True, future
+    def finish(self, key: str, future: asyncio.Future, result: Optional[tuple]):
+        """Stores `result` for replay; `None` forgets the key so waiting duplicates retry it themselves."""
+        entry = self.in_flight.get(key)
+        if entry and entry[1] is future:
+            del self.in_flight[key]
+            if result is not None: self.stored[key] = (time.monotonic() + self.ttl, entry[0], result)
+        if not future.done(): future.set_result(result)
+idempotency_store = IdempotencyStore(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL_SECONDS)
+
+# --- Admission Control ---
+class AdmissionLimiter:
+    """Concurrency limit for one endpoint class with a bounded FIFO wait queue; priority waiters are always served first."""
+    def __init__(self, name: str, limit: int, queue: int, deadline: float):
+        self.name = name; self.limit = limit; self.max_queue = queue; self.deadline = deadline
+        self.active = 0; self.shed_count = 0
+        self.waiters: deque = deque(); self.priority_waiters: deque = deque()
+    def settings(self) -> dict: return {"limit": self.limit, "queue": self.max_queue, "deadline": self.deadline}
+    def configure(self, limit: int, queue: int, deadline: float):
+        self.limit = limit; self.max_queue = queue; self.deadline = deadline
+        while self.active < self.limit and self._handoff(): self.active += 1
+    def is_saturated(self) -> bool: return self.active >= self.limit
+    def _handoff(self) -> bool:
+        for waiters in (self.priority_waiters, self.waiters):
+            while waiters:
+                future = waiters.popleft()
+                if not future.done(): future.set_result(True); return True
+        return False
+    def _reject(self, status_code: int, detail: str):
+        self.shed_count += 1
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(int(self.deadline) + 1)})
+    async def acquire(self, priority: bool = False, shed: bool = True):
+        """Waits for a slot. Raises 429 when the queue is full and 503 when the deadline passes, unless `shed` is False."""
+        if self.active < self.limit and not (self.priority_waiters or self.waiters): self.active += 1; return
+        if shed and not priority and len(self.waiters) >= self.max_queue: self._reject(429, "Server is busy. Please retry shortly.")
+        future = asyncio.get_running_loop().create_future()
+        waiters = self.priority_waiters if priority else self.waiters
+        waiters.append(future)
+        try: await asyncio.wait_for(future, self.deadline if shed else None)
+        except asyncio.TimeoutError:
+            if future in waiters: waiters.remove(future)
+            self._reject(503, "Server is overloaded. Please retry shortly.")
+        except asyncio.CancelledError:
+            # The slot may have been handed over just as the caller went away.
+            if future.done() and not future.cancelled(): self.release()
+            raise
+    def release(self):
+        # After a live decrease of `limit`, slots drain instead of being handed over.
+        if self.active > self.limit or not self._handoff(): self.active -= 1
+    @asynccontextmanager
+    async def reserved(self):
+        """Top-priority slot that is never shed, for work that must not be dropped (game settlement)."""
+        await self.acquire(priority=True, shed=False)
+        try: yield
+        finally: self.release()
+admission_limiters = {name: AdmissionLimiter(name, **settings) for name, settings in ADMISSION_DEFAULTS.items()}
+
+def apply_admission_settings(raw: Optional[str]):
+    try: saved = json.loads(raw) if raw else {}
+    except ValueError: saved = {}
+    for name, limiter in admission_limiters.items():
+        limiter.configure(**{**ADMISSION_DEFAULTS[name], **saved.get(name, {})})
+
+# --- Per-User Locks ---
+class UserLockManager:
+    """One `asyncio.Lock` per user id, held in a WeakValueDictionary so it is dropped once nobody holds or awaits it."""
+    def __init__(self): self.locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+    def _lock(self, user_id: int) -> asyncio.Lock:
+        lock = self.locks.get(user_id)
+        if lock is None: lock = asyncio.Lock(); self.locks[user_id] = lock
+        return lock
+    @asynccontextmanager
+    async def hold(self, *user_ids: Optional[int]):
+        """Locks every given user in ascending id order, so two-party operations can never deadlock each other."""
+        locks = [self._lock(user_id) for user_id in sorted({int(u) for u in user_ids if u is not None})]
+        acquired = []
+        try:
+            for lock in locks: await lock.acquire(); acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired): lock.release()
+user_locks = UserLockManager()
+
 # --- Bot & API Lifespan ---
 ptb_app = Application.builder().token(BOT_TOKEN).build()
+async def send_notice(chat_id: int, text: str, **kwargs):
+    """Sends a bot message about an already committed change; failures (e.g. the user blocked the bot) are logged, not raised."""
+    try: await ptb_app.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    except Exception as e: logger.error(f"Failed to notify {chat_id}: {e}")
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Lifespan startup...")
@@ -105,15 +307,70 @@ async def lifespan(app: FastAPI):
         for key, value in [('global_maintenance', 'false'), ('withdrawal_maintenance', 'false'), ('announcement', 'Welcome! No new announcements.')]:
             if not db.query(SystemInfo).filter(SystemInfo.key == key).first():
                 db.add(SystemInfo(key=key, value=value)); db.commit()
+        # `create_all` does not add indexes to tables that already exist.
+        db.execute(text("CREATE INDEX IF NOT EXISTS ix_users_referrer_id ON users (referrer_id)")); db.commit()
+        referral_graph.load(db)
+        admission_settings = db.query(SystemInfo).filter(SystemInfo.key == 'admission_settings').first()
+        apply_admission_settings(admission_settings.value if admission_settings else None)
+    leaderboard_task = asyncio.create_task(refresh_leaderboards_periodically())
     await ptb_app.initialize()
     await ptb_app.updater.start_polling(drop_pending_updates=True)
     await ptb_app.start()
     logger.info("Telegram bot has started successfully.")
     yield
-    logger.info("Lifespan shutdown..."); await ptb_app.updater.stop(); await ptb_app.stop(); await ptb_app.shutdown()
+    logger.info("Lifespan shutdown..."); leaderboard_task.cancel(); await ptb_app.updater.stop(); await ptb_app.stop(); await ptb_app.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
+
+# Registered first so it runs innermost: idempotent replays never queue for a slot.
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    endpoint_class = ADMISSION_ENDPOINT_CLASSES.get(request.url.path)
+    if not endpoint_class: return await call_next(request)
+    limiter = admission_limiters[endpoint_class]
+    # Only admin requests jump the queue (game settlement takes a reserved slot instead); there are too few to need a cap.
+    priority = False
+    if request.method == "POST" and limiter.is_saturated():
+        try: priority = json.loads(await request.body()).get('user_id') == ADMIN_CHAT_ID
+        except Exception: pass
+    try: await limiter.acquire(priority=priority)
+    except HTTPException as e:
+        request.state.admission_shed = True # Tells the idempotency layer not to store this response.
+        return JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
+    try: return await call_next(request)
+    finally: limiter.release()
+
+# Registered before CORS so replayed responses still get CORS headers.
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    key = request.headers.get("Idempotency-Key")
+    if request.method != "POST" or request.url.path not in IDEMPOTENT_PATHS or not key: return await call_next(request)
+    body = await request.body()
+    try: user_id = json.loads(body).get('user_id')
+    except Exception: user_id = None
+    scoped_key, body_hash = f"{request.url.path}:{user_id}:{key}", hashlib.sha256(body).hexdigest()
+
+    while True:
+        try: is_owner, future = idempotency_store.begin(scoped_key, body_hash)
+        except HTTPException as e: return JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
+        if is_owner: break
+        try: result = await asyncio.wait_for(asyncio.shield(future), IDEMPOTENCY_WAIT_SECONDS)
+        except asyncio.TimeoutError: return JSONResponse(status_code=409, content={"detail": "A request with this Idempotency-Key is still being processed."}, headers={"Retry-After": "1"})
+        if result:
+            status_code, content, media_type = result
+            return Response(content=content, status_code=status_code, media_type=media_type, headers={"Idempotent-Replayed": "true"})
+
+    result = None
+    try:
+        response = await call_next(request)
+        content = b"".join([chunk async for chunk in response.body_iterator])
+        # Once the endpoint has run, its result is final, even a 5xx: it may already have moved money.
+        # Only requests shed by admission control never reached it, so those may be retried for real.
+        if not getattr(request.state, 'admission_shed', False): result = (response.status_code, content, response.headers.get("content-type"))
+        return Response(content=content, status_code=response.status_code, headers=dict(response.headers))
+    finally: idempotency_store.finish(scoped_key, future, result)
+
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
 # --- API Endpoints ---
@@ -172,16 +429,32 @@ async def get_initial_data(req: UserAuthRequest, db: Session = Depends(get_db)):
         "game_rooms": [{"id": r.id, "bet": r.bet_amount, "creator_id": r.creator_id} for r in game_rooms]
     }
 
+@app.post("/get_referral_info")
+async def get_referral_info(req: UserAuthRequest, db: Session = Depends(get_db)):
+    user = db.query(User).filter(User.id == req.user_id).first()
+    if not user: raise HTTPException(status_code=404, detail=f"User not found. Please start the bot first: @{BOT_USERNAME}")
+    recruits = referral_graph.recruits(req.user_id)
+    return {
+        "referral_count": user.referral_count, "successful_referrals": user.successful_referrals,
+        "direct_recruits": recruits[:REFERRAL_LIST_LIMIT], "direct_recruit_count": len(recruits),
+        "downline_size": referral_graph.downline(req.user_id), "referrer_id": user.referrer_id,
+        "ranks": {board: leaderboards.rank(board, req.user_id) for board in Leaderboards.BOARDS}
+    }
+
+@app.get("/leaderboards")
+async def get_leaderboards(): return leaderboards.snapshot()
+
 @app.post("/submit_task_proof")
 async def submit_task_proof(req: TaskProofRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
-    if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
+    async with user_locks.hold(req.user_id):
+        user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
+        if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
     
-    completed_ids = json.loads(user.completed_task_ids)
-    if req.task_id in completed_ids: raise HTTPException(status_code=400, detail="Task already completed.")
+        completed_ids = json.loads(user.completed_task_ids)
+        if req.task_id in completed_ids: raise HTTPException(status_code=400, detail="Task already completed.")
 
-    submission = TaskSubmission(user_id=req.user_id, task_id=req.task_id, text_proof=req.text, photo_proof_base64=req.photo)
-    db.add(submission); db.commit(); db.refresh(submission)
+        submission = TaskSubmission(user_id=req.user_id, task_id=req.task_id, text_proof=req.text, photo_proof_base64=req.photo)
+        db.add(submission); db.commit(); db.refresh(submission)
     
     task = db.query(Task).filter(Task.id == req.task_id).first()
     caption = f"**New Task Submission**\n\n- User: `{req.user_id}` ({user.first_name})\n- Task: {task.description}\n- Reward: ₱{task.reward:.2f}\n- Note: {req.text or 'N/A'}"
@@ -190,45 +463,46 @@ async def submit_task_proof(req: TaskProofRequest, db: Session = Depends(get_db)
     try:
         photo_data = base64.b64decode(req.photo.split(',')[1])
         await ptb_app.bot.send_photo(chat_id=ADMIN_CHAT_ID, photo=BytesIO(photo_data), caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        await ptb_app.bot.send_message(req.user_id, "✅ Your proof has been submitted for admin review!")
     except Exception as e:
+        # The submission is already committed and still shows up under Review Submissions.
         logger.error(f"Failed to send task submission to admin: {e}")
-        raise HTTPException(status_code=500, detail="Could not process submission notification.")
+    await send_notice(req.user_id, "✅ Your proof has been submitted for admin review!")
 
     return {"status": "success"}
 
 @app.post("/redeem_code")
 async def redeem_code(req: RedeemCodeRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
-    if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
-
-    code = db.query(RedeemCode).filter(RedeemCode.code == req.code.upper()).with_for_update().first()
-    if code and (code.uses_left == -1 or code.uses_left > 0):
-        user.balance += code.reward
-        if code.uses_left != -1: code.uses_left -= 1
-        db.commit()
-        return {"status": "success", "amount_rewarded": code.reward}
-    else:
-        raise HTTPException(status_code=400, detail="Invalid or expired code.")
+    async with user_locks.hold(req.user_id):
+        user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
+        if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
+
+        code = db.query(RedeemCode).filter(RedeemCode.code == req.code.upper()).with_for_update().first()
+        if code and (code.uses_left == -1 or code.uses_left > 0):
+            user.balance += code.reward
+            if code.uses_left != -1: code.uses_left -= 1
+            db.commit()
+            return {"status": "success", "amount_rewarded": code.reward}
+        else:
+            raise HTTPException(status_code=400, detail="Invalid or expired code.")
 
 @app.post("/claim_daily_bonus")
 async def claim_daily_bonus(req: UserAuthRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
-    if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
-    
-    if user.last_login_date is None or user.last_login_date < date.today():
-        if user.daily_claim_invites >= DAILY_BONUS_INVITE_REQ:
-            user.balance += DAILY_BONUS
-            user.last_login_date = date.today()
-            user.daily_claim_invites = 0
-            db.commit()
-            await ptb_app.bot.send_message(req.user_id, f"🎉 Daily bonus of ₱{DAILY_BONUS:.2f} claimed!")
-            return {"status": "success"}
-        else:
+    async with user_locks.hold(req.user_id):
+        user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
+        if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
+
+        if user.last_login_date is not None and user.last_login_date >= date.today():
+            raise HTTPException(status_code=400, detail="Daily bonus already claimed for today.")
+        if user.daily_claim_invites < DAILY_BONUS_INVITE_REQ:
             needed = DAILY_BONUS_INVITE_REQ - user.daily_claim_invites
             raise HTTPException(status_code=400, detail=f"Invite {needed} more user(s) to claim your daily bonus.")
-    else:
-        raise HTTPException(status_code=400, detail="Daily bonus already claimed for today.")
+
+        user.balance += DAILY_BONUS
+        user.last_login_date = date.today()
+        user.daily_claim_invites = 0
+        db.commit()
+    await send_notice(req.user_id, f"🎉 Daily bonus of ₱{DAILY_BONUS:.2f} claimed!")
+    return {"status": "success"}
 
 @app.post("/submit_withdrawal")
 async def submit_withdrawal(req: WithdrawalRequest, db: Session = Depends(get_db)):
@@ -236,94 +510,99 @@ async def submit_withdrawal(req: WithdrawalRequest, db: Session = Depends(get_db
     if wd_maintenance and wd_maintenance.value == "true":
         raise HTTPException(status_code=503, detail="Withdrawals are under maintenance. Please try again later.")
 
-    user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
-    if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
-    if not (MIN_WITHDRAWAL <= req.amount <= MAX_WITHDRAWAL):
-        raise HTTPException(status_code=400, detail=f"Amount must be between ₱{MIN_WITHDRAWAL:.2f} and ₱{MAX_WITHDRAWAL:.2f}.")
+    async with user_locks.hold(req.user_id):
+        user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
+        if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
+        if not (MIN_WITHDRAWAL <= req.amount <= MAX_WITHDRAWAL):
+            raise HTTPException(status_code=400, detail=f"Amount must be between ₱{MIN_WITHDRAWAL:.2f} and ₱{MAX_WITHDRAWAL:.2f}.")
     
-    fee = req.amount * WITHDRAWAL_FEE_PERCENT
-    total_deduction = req.amount + fee
+        fee = req.amount * WITHDRAWAL_FEE_PERCENT
+        total_deduction = req.amount + fee
 
-    if user.balance < total_deduction:
-        raise HTTPException(status_code=400, detail="Insufficient balance to cover withdrawal amount and fee.")
+        if user.balance < total_deduction:
+            raise HTTPException(status_code=400, detail="Insufficient balance to cover withdrawal amount and fee.")
     
-    user.balance -= total_deduction
-    new_withdrawal = Withdrawal(user_id=user.id, amount=req.amount, fee=fee, method=req.method, details=req.details)
-    db.add(new_withdrawal); db.commit(); db.refresh(new_withdrawal)
+        user.balance -= total_deduction
+        new_withdrawal = Withdrawal(user_id=user.id, amount=req.amount, fee=fee, method=req.method, details=req.details)
+        db.add(new_withdrawal); db.commit(); db.refresh(new_withdrawal)
     
-    await ptb_app.bot.send_message(req.user_id, f"✅ Your withdrawal request for ₱{req.amount:.2f} (Fee: ₱{fee:.2f}) has been submitted!")
+    await send_notice(req.user_id, f"✅ Your withdrawal request for ₱{req.amount:.2f} (Fee: ₱{fee:.2f}) has been submitted!")
     admin_msg = f"**New Withdrawal Request**\n\n- User: `{user.id}` ({user.first_name})\n- Amount: `₱{req.amount:.2f}`\n- Fee: `₱{fee:.2f}`\n- Method: `{req.method}`\n- Details: `{req.details}`"
     keyboard = [[InlineKeyboardButton("Approve ✅", callback_data=f"approve_wd_{new_withdrawal.id}"), InlineKeyboardButton("Reject ❌", callback_data=f"reject_wd_start_{new_withdrawal.id}")]]
-    await ptb_app.bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await send_notice(ADMIN_CHAT_ID, admin_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
     return {"status": "success"}
 
 @app.post("/buy_ticket")
 async def buy_ticket(req: UserAuthRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
-    if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
-    if user.balance < GIFT_TICKET_PRICE: raise HTTPException(status_code=400, detail="Insufficient balance to buy a Gift Ticket.")
+    async with user_locks.hold(req.user_id):
+        user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
+        if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
+        if user.balance < GIFT_TICKET_PRICE: raise HTTPException(status_code=400, detail="Insufficient balance to buy a Gift Ticket.")
     
-    user.balance -= GIFT_TICKET_PRICE
-    user.gift_tickets += 2
-    db.commit()
-    await ptb_app.bot.send_message(req.user_id, f"🎉 Purchase successful! You received 2 Gift Tickets. You now have {user.gift_tickets} tickets.")
+        user.balance -= GIFT_TICKET_PRICE
+        user.gift_tickets += 2
+        db.commit()
+    await send_notice(req.user_id, f"🎉 Purchase successful! You received 2 Gift Tickets. You now have {user.gift_tickets} tickets.")
     return {"status": "success"}
 
 @app.post("/gift_money")
 async def gift_money(req: GiftMoneyRequest, db: Session = Depends(get_db)):
-    sender = db.query(User).filter(User.id == req.user_id).with_for_update().first()
-    if not sender or sender.status != 'active': raise HTTPException(status_code=403, detail="Sender account not active.")
-    if sender.gift_tickets < 1: raise HTTPException(status_code=400, detail="You do not have any Gift Tickets.")
-    if not (GIFT_MIN_AMOUNT <= req.amount <= GIFT_MAX_AMOUNT): raise HTTPException(status_code=400, detail=f"Amount must be between ₱{GIFT_MIN_AMOUNT:.2f} and ₱{GIFT_MAX_AMOUNT:.2f}.")
+    async with user_locks.hold(req.user_id, req.recipient_id):
+        sender = db.query(User).filter(User.id == req.user_id).with_for_update().first()
+        if not sender or sender.status != 'active': raise HTTPException(status_code=403, detail="Sender account not active.")
+        if sender.gift_tickets < 1: raise HTTPException(status_code=400, detail="You do not have any Gift Tickets.")
+        if not (GIFT_MIN_AMOUNT <= req.amount <= GIFT_MAX_AMOUNT): raise HTTPException(status_code=400, detail=f"Amount must be between ₱{GIFT_MIN_AMOUNT:.2f} and ₱{GIFT_MAX_AMOUNT:.2f}.")
     
-    fee = req.amount * GIFT_FEE_PERCENT
-    total_deduction = req.amount + fee
-    if sender.balance < total_deduction: raise HTTPException(status_code=400, detail="Insufficient balance to cover gift and fee.")
+        fee = req.amount * GIFT_FEE_PERCENT
+        total_deduction = req.amount + fee
+        if sender.balance < total_deduction: raise HTTPException(status_code=400, detail="Insufficient balance to cover gift and fee.")
 
-    recipient = db.query(User).filter(User.id == req.recipient_id).with_for_update().first()
-    if not recipient: raise HTTPException(status_code=404, detail="Recipient user not found.")
-    if recipient.status != 'active': raise HTTPException(status_code=400, detail="Recipient account is not active.")
+        recipient = db.query(User).filter(User.id == req.recipient_id).with_for_update().first()
+        if not recipient: raise HTTPException(status_code=404, detail="Recipient user not found.")
+        if recipient.status != 'active': raise HTTPException(status_code=400, detail="Recipient account is not active.")
 
-    sender.balance -= total_deduction
-    sender.gift_tickets -= 1
-    recipient.balance += req.amount
-    db.commit()
+        sender.balance -= total_deduction
+        sender.gift_tickets -= 1
+        recipient.balance += req.amount
+        db.commit()
 
-    await ptb_app.bot.send_message(req.user_id, f"✅ You gifted ₱{req.amount:.2f} to user {req.recipient_id}. Fee: ₱{fee:.2f}.")
-    await ptb_app.bot.send_message(recipient.id, f"🎉 You have received a gift of ₱{req.amount:.2f} from user {req.user_id}!")
+    await send_notice(req.user_id, f"✅ You gifted ₱{req.amount:.2f} to user {req.recipient_id}. Fee: ₱{fee:.2f}.")
+    await send_notice(recipient.id, f"🎉 You have received a gift of ₱{req.amount:.2f} from user {req.user_id}!")
     return {"status": "success"}
 
 @app.post("/create_game_room")
 async def create_game_room(req: CreateGameRoomRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
-    if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
-    if req.bet < MIN_GAME_BET: raise HTTPException(status_code=400, detail=f"Minimum bet is ₱{MIN_GAME_BET:.2f}.")
-    if user.balance < req.bet: raise HTTPException(status_code=400, detail="Insufficient balance.")
+    async with user_locks.hold(req.user_id):
+        user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
+        if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
+        if req.bet < MIN_GAME_BET: raise HTTPException(status_code=400, detail=f"Minimum bet is ₱{MIN_GAME_BET:.2f}.")
+        if user.balance < req.bet: raise HTTPException(status_code=400, detail="Insufficient balance.")
     
-    user.balance -= req.bet
-    new_room = GameRoom(creator_id=req.user_id, bet_amount=req.bet, status='pending')
-    db.add(new_room); db.commit(); db.refresh(new_room)
-    await ptb_app.bot.send_message(req.user_id, f"✅ Game room #{new_room.id} created with a bet of ₱{req.bet:.2f}. Your balance is now ₱{user.balance:.2f}.")
+        user.balance -= req.bet
+        new_room = GameRoom(creator_id=req.user_id, bet_amount=req.bet, status='pending')
+        db.add(new_room); db.commit(); db.refresh(new_room)
+    await send_notice(req.user_id, f"✅ Game room #{new_room.id} created with a bet of ₱{req.bet:.2f}. Your balance is now ₱{user.balance:.2f}.")
     return {"status": "success", "room_id": new_room.id}
 
 @app.post("/join_game_room")
 async def join_game_room(req: JoinGameRoomRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
-    room = db.query(GameRoom).filter(GameRoom.id == req.room_id, GameRoom.status == 'pending').with_for_update().first()
+    async with user_locks.hold(req.user_id):
+        user = db.query(User).filter(User.id == req.user_id).with_for_update().first()
+        room = db.query(GameRoom).filter(GameRoom.id == req.room_id, GameRoom.status == 'pending').with_for_update().first()
     
-    if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
-    if not room: raise HTTPException(status_code=404, detail="Room not found or is no longer available.")
-    if user.id == room.creator_id: raise HTTPException(status_code=400, detail="You cannot join your own room.")
-    if user.balance < room.bet_amount: raise HTTPException(status_code=400, detail="Insufficient balance to join.")
+        if not user or user.status != 'active': raise HTTPException(status_code=403, detail="Account not active.")
+        if not room: raise HTTPException(status_code=404, detail="Room not found or is no longer available.")
+        if user.id == room.creator_id: raise HTTPException(status_code=400, detail="You cannot join your own room.")
+        if user.balance < room.bet_amount: raise HTTPException(status_code=400, detail="Insufficient balance to join.")
     
-    user.balance -= room.bet_amount
-    room.opponent_id = req.user_id
-    room.status = 'active'
-    db.commit()
+        user.balance -= room.bet_amount
+        room.opponent_id = req.user_id
+        room.status = 'active'
+        db.commit()
     
     creator = db.query(User).get(room.creator_id)
-    await ptb_app.bot.send_message(req.user_id, f"✅ You joined Game Room #{room.id}. Your balance is now ₱{user.balance:.2f}. Good luck!")
-    await ptb_app.bot.send_message(room.creator_id, f"🎉 An opponent ({creator.first_name if creator else room.creator_id}) has joined your Game Room #{room.id}! The game starts now.")
+    await send_notice(req.user_id, f"✅ You joined Game Room #{room.id}. Your balance is now ₱{user.balance:.2f}. Good luck!")
+    await send_notice(room.creator_id, f"🎉 An opponent ({creator.first_name if creator else room.creator_id}) has joined your Game Room #{room.id}! The game starts now.")
     
     await manager.broadcast(room.id, json.dumps({"type": "game_start", "creator_id": room.creator_id, "opponent_id": room.opponent_id}))
     return {"status": "success"}
@@ -349,29 +628,35 @@ async def websocket_endpoint(websocket: WebSocket, room_id: int, user_id: int):
                 await manager.broadcast(room.id, json.dumps({"type": "move_made", "user_id": user_id}))
 
                 if room.creator_move and room.opponent_move:
-                    c_move, o_move = room.creator_move, room.opponent_move
+                    # Settlement is never shed and jumps ahead of queued money writes.
+                    async with admission_limiters["write"].reserved(), user_locks.hold(room.creator_id, room.opponent_id):
+                        db.refresh(room)
+                        # The other player's handler may have settled the room while we waited for the lock.
+                        if room.status != 'active': continue
+                        c_move, o_move = room.creator_move, room.opponent_move
                     
-                    if c_move == o_move: winner_id = -1
-                    elif (c_move, o_move) in [('rock', 'scissors'), ('scissors', 'paper'), ('paper', 'rock')]: winner_id = room.creator_id
-                    else: winner_id = room.opponent_id
+                        if c_move == o_move: winner_id = -1
+                        elif (c_move, o_move) in [('rock', 'scissors'), ('scissors', 'paper'), ('paper', 'rock')]: winner_id = room.creator_id
+                        else: winner_id = room.opponent_id
                     
-                    room.status = 'finished'; room.winner_id = winner_id
+                        room.status = 'finished'; room.winner_id = winner_id
                     
-                    creator = db.query(User).filter(User.id == room.creator_id).with_for_update().first()
-                    opponent = db.query(User).filter(User.id == room.opponent_id).with_for_update().first()
-
-                    if winner_id == -1:
-                        creator.balance += room.bet_amount; opponent.balance += room.bet_amount
-                        await ptb_app.bot.send_message(creator.id, f"Game #{room.id} was a draw! Your bet was returned.")
-                        await ptb_app.bot.send_message(opponent.id, f"Game #{room.id} was a draw! Your bet was returned.")
-                    else:
-                        prize = (room.bet_amount * 2) * (1 - GAME_FEE_PERCENT)
-                        winner_user, loser_user = (creator, opponent) if winner_id == creator.id else (opponent, creator)
-                        winner_user.balance += prize
-                        await ptb_app.bot.send_message(winner_user.id, f"🎉 You won Game #{room.id}! You received ₱{prize:.2f}.")
-                        await ptb_app.bot.send_message(loser_user.id, f"😭 You lost Game #{room.id}.")
+                        creator = db.query(User).filter(User.id == room.creator_id).with_for_update().first()
+                        opponent = db.query(User).filter(User.id == room.opponent_id).with_for_update().first()
+
+                        if winner_id == -1:
+                            creator.balance += room.bet_amount; opponent.balance += room.bet_amount
+                            notices = [(creator.id, f"Game #{room.id} was a draw! Your bet was returned."), (opponent.id, f"Game #{room.id} was a draw! Your bet was returned.")]
+                        else:
+                            prize = (room.bet_amount * 2) * (1 - GAME_FEE_PERCENT)
+                            winner_user, loser_user = (creator, opponent) if winner_id == creator.id else (opponent, creator)
+                            winner_user.balance += prize
+                            notices = [(winner_user.id, f"🎉 You won Game #{room.id}! You received ₱{prize:.2f}."), (loser_user.id, f"😭 You lost Game #{room.id}.")]
                     
-                    db.commit()
+                        db.commit()
+                    # Notify outside the locks so a slow Telegram or socket round-trip doesn't hold them.
+                    if winner_id != -1: leaderboards.bump_winnings(db, winner_id)
+                    for chat_id, notice in notices: await send_notice(chat_id, notice)
                     await manager.broadcast(room.id, json.dumps({"type": "game_over", "winner": winner_id, "creator_move": c_move, "opponent_move": o_move}))
             elif data.get('type') == 'request_status':
                  room = db.query(GameRoom).filter(GameRoom.id == room_id).first()
@@ -382,23 +667,31 @@ async def websocket_endpoint(websocket: WebSocket, room_id: int, user_id: int):
                         "creator_move": room.creator_move, "opponent_move": room.opponent_move,
                     }))
     except WebSocketDisconnect:
-        room = db.query(GameRoom).filter(GameRoom.id == room_id, (GameRoom.status == 'active' or GameRoom.status == 'pending')).with_for_update().first()
-        if room and room.winner_id is None:
-            if room.status == 'pending':
-                creator = db.query(User).filter(User.id == room.creator_id).with_for_update().first()
-                if creator: creator.balance += room.bet_amount; await ptb_app.bot.send_message(creator.id, f"Game Room #{room.id} cancelled due to creator disconnect. Your bet returned.")
-            else:
-                remaining_player_id = room.opponent_id if user_id == room.creator_id else room.creator_id
-                winner_id = remaining_player_id
-                winner = db.query(User).filter(User.id == winner_id).with_for_update().first()
-                if winner:
-                    prize = (room.bet_amount * 2) * (1 - GAME_FEE_PERCENT)
-                    winner.balance += prize
-                    await ptb_app.bot.send_message(winner_id, f"🎉 Opponent disconnected from Game #{room.id}. You win ₱{prize:.2f} by default!")
-                await manager.broadcast(room.id, json.dumps({"type": "game_over", "winner": winner_id, "message": "Opponent disconnected."}))
+        room = db.query(GameRoom).filter(GameRoom.id == room_id, GameRoom.status.in_(('active', 'pending'))).with_for_update().first()
+        if room:
+            notices, game_over = [], None
+            async with user_locks.hold(room.creator_id, room.opponent_id):
+                db.refresh(room)
+                if room.winner_id is None and room.status in ('active', 'pending'):
+                    if room.status == 'pending':
+                        creator = db.query(User).filter(User.id == room.creator_id).with_for_update().first()
+                        if creator: creator.balance += room.bet_amount; notices.append((creator.id, f"Game Room #{room.id} cancelled due to creator disconnect. Your bet returned."))
+                    else:
+                        remaining_player_id = room.opponent_id if user_id == room.creator_id else room.creator_id
+                        winner_id = remaining_player_id
+                        room.winner_id = winner_id
+                        winner = db.query(User).filter(User.id == winner_id).with_for_update().first()
+                        if winner:
+                            prize = (room.bet_amount * 2) * (1 - GAME_FEE_PERCENT)
+                            winner.balance += prize
+                            notices.append((winner_id, f"🎉 Opponent disconnected from Game #{room.id}. You win ₱{prize:.2f} by default!"))
+                        game_over = json.dumps({"type": "game_over", "winner": winner_id, "message": "Opponent disconnected."})
                 
-            room.status = 'cancelled'
-            db.commit()
+                    room.status = 'cancelled'
+                    db.commit()
+            if game_over: leaderboards.bump_winnings(db, room.winner_id)
+            for chat_id, notice in notices: await send_notice(chat_id, notice)
+            if game_over: await manager.broadcast(room.id, game_over)
     except Exception as e:
         logger.error(f"WebSocket Error in room {room_id} for user {user_id}: {e}", exc_info=True)
     finally:
@@ -414,14 +707,22 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 referrer_id = int(context.args[0])
                 if referrer_id != user_tg.id and not user_db:
-                    referrer = db.query(User).filter(User.id == referrer_id).with_for_update().first()
-                    if referrer:
-                        referrer.referral_count += 1
-                        referrer.daily_claim_invites += 1
-                        user_db = User(id=user_tg.id, first_name=user_tg.first_name, referrer_id=referrer_id)
-                        db.add(user_db)
-                        db.commit()
-                        await context.bot.send_message(chat_id=referrer.id, text=f"🎉 {user_tg.first_name} has joined using your link!")
+                    joined = False
+                    async with user_locks.hold(user_tg.id, referrer_id):
+                        # A repeated /start may have registered this user while we waited for the lock.
+                        user_db = db.query(User).filter(User.id == user_tg.id).first()
+                        referrer = db.query(User).filter(User.id == referrer_id).with_for_update().first()
+                        if referrer and not user_db:
+                            referrer.referral_count += 1
+                            referrer.daily_claim_invites += 1
+                            user_db = User(id=user_tg.id, first_name=user_tg.first_name, referrer_id=referrer_id)
+                            db.add(user_db)
+                            db.commit()
+                            referral_graph.add_user(user_db.id, referrer_id)
+                            leaderboards.bump("referrals", referrer.id, referrer.first_name, referrer.referral_count)
+                            joined = True
+                    if joined:
+                        await context.bot.send_message(chat_id=referrer_id, text=f"🎉 {user_tg.first_name} has joined using your link!")
             except (ValueError, IndexError): pass
         if not user_db:
             user_db = User(id=user_tg.id, first_name=user_tg.first_name)
@@ -441,6 +742,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🔨 User Management", callback_data="admin_user_mgt"), InlineKeyboardButton("⚠️ Warn User", callback_data="admin_warn_user")],
         [InlineKeyboardButton("🌧️ Rain Prize", callback_data="admin_rain"), InlineKeyboardButton("🎲 Manage Games", callback_data="admin_manage_games")],
         [InlineKeyboardButton("⚙️ Maintenance", callback_data="admin_maintenance"), InlineKeyboardButton("📋 Review Submissions", callback_data="admin_pending_submissions")],
+        [InlineKeyboardButton("🚦 Admission Control", callback_data="admin_admission")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     if update.callback_query:
@@ -532,6 +834,10 @@ async def user_lookup_id_input(update: Update, context: ContextTypes.DEFAULT_TYP
         if user.referrer_id:
             referrer = db.query(User).filter(User.id == user.referrer_id).first()
             referrer_info = f"{referrer.first_name} (`{user.referrer_id}`)" if referrer else f"`{user.referrer_id}` (Not Found)"
+        recruits = referral_graph.recruits(user.id)
+        recruits_info = (", ".join(f"`{r}`" for r in recruits[:10]) + (f" (+{len(recruits) - 10} more)" if len(recruits) > 10 else "")) if recruits else "None"
+        ranks = {board: leaderboards.rank(board, user.id) for board in Leaderboards.BOARDS}
+        ranks_info = ", ".join(f"{board.capitalize()} #{rank}" for board, rank in ranks.items() if rank) or "Unranked"
         
         info_text = f"""
 **🔍 User Info for {user.first_name} (`{user.id}`)**
@@ -545,6 +851,10 @@ async def user_lookup_id_input(update: Update, context: ContextTypes.DEFAULT_TYP
 - **Recruited:** `{user.referral_count}`
 - **Successful:** `{user.successful_referrals}`
 - **Referred By:** {referrer_info}
+- **Downline (all levels):** `{referral_graph.downline(user.id)}`
+- **Direct Recruits:** {recruits_info}
+
+**Leaderboard Ranks:** {ranks_info}
 """
         await update.message.reply_text(info_text, parse_mode='Markdown')
     await admin_command(update, context)
@@ -581,6 +891,40 @@ async def toggle_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     await admin_maintenance(update, context)
 
+# --- Admission Control Panel ---
+async def admin_admission(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not query.data.startswith("admission_"): await query.answer()
+    lines = [f"**{name.upper()}:** limit `{limiter.limit}`, queue `{limiter.max_queue}`, deadline `{limiter.deadline:.1f}s`\n  active `{limiter.active}`, waiting `{len(limiter.waiters) + len(limiter.priority_waiters)}`, shed `{limiter.shed_count}`" for name, limiter in admission_limiters.items()]
+    keyboard = [[InlineKeyboardButton(f"{name.capitalize()} {label}{sign}", callback_data=f"admission_{name}_{field}_{step}")
+                 for field, label in (("limit", "L"), ("queue", "Q"), ("deadline", "D")) for step, sign in (("dec", "➖"), ("inc", "➕"))]
+                for name in admission_limiters]
+    keyboard.append([InlineKeyboardButton("🔄 Refresh", callback_data="admin_admission"), InlineKeyboardButton("⬅️ Back", callback_data="admin_back")])
+    text = "🚦 **Admission Control**\n\n" + "\n".join(lines) + "\n\nL = concurrent requests, Q = max waiting, D = max wait before shedding."
+    try: await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    except BadRequest as e:
+        # Refreshing with unchanged counters re-sends the same message, which Telegram rejects.
+        if "not modified" not in str(e): raise
+
+async def tune_admission(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, name, field, step = query.data.split("_")
+    limiter = admission_limiters[name]
+    settings = limiter.settings()
+    delta = ADMISSION_TUNING_STEPS[field] if step == "inc" else -ADMISSION_TUNING_STEPS[field]
+    new_value = max(ADMISSION_TUNING_MINIMUMS[field], settings[field] + delta)
+    if new_value == settings[field]: await query.answer(f"{name.capitalize()} {field} is already at its minimum."); return
+    settings[field] = new_value
+    limiter.configure(**settings)
+
+    with SessionLocal() as db:
+        setting = db.query(SystemInfo).filter(SystemInfo.key == 'admission_settings').with_for_update().first()
+        if not setting: setting = SystemInfo(key='admission_settings'); db.add(setting)
+        setting.value = json.dumps({limiter_name: configured.settings() for limiter_name, configured in admission_limiters.items()})
+        db.commit()
+    await query.answer(f"{name.capitalize()} {field} set to {settings[field]}")
+    await admin_admission(update, context)
+
 # --- Task Management ---
 async def admin_manage_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query; await query.answer()
@@ -654,27 +998,37 @@ async def approve_submission(update: Update, context: ContextTypes.DEFAULT_TYPE)
     with SessionLocal() as db:
         submission = db.query(TaskSubmission).filter(TaskSubmission.id == sub_id).with_for_update().first()
         if not submission or submission.status != 'pending': await query.edit_message_caption("Already processed."); return
-        submission.status = 'approved'
-        user = db.query(User).filter(User.id == submission.user_id).with_for_update().first()
-        task = db.query(Task).filter(Task.id == submission.task_id).first()
+        referrer_id = db.query(User.referrer_id).filter(User.id == submission.user_id).scalar()
+        notices = []
+        async with user_locks.hold(submission.user_id, referrer_id):
+            # A second click may have approved it while we waited for the lock.
+            db.refresh(submission)
+            already_processed = submission.status != 'pending'
+            if not already_processed:
+                submission.status = 'approved'
+                user = db.query(User).filter(User.id == submission.user_id).with_for_update().first()
+                task = db.query(Task).filter(Task.id == submission.task_id).first()
         
-        # Financial/Milestone Logic (Safe due to `with_for_update` and explicit session)
-        completed_ids = json.loads(user.completed_task_ids)
-        if task.id not in completed_ids:
-            user.balance += task.reward; user.tasks_completed += 1; completed_ids.append(task.id); user.completed_task_ids = json.dumps(completed_ids)
-            claimed_milestones = json.loads(user.claimed_milestones)
-            for ms_key, ms_reward in TASK_MILESTONES.items():
-                ms_count = int(ms_key.split('_')[0])
-                if user.tasks_completed == ms_count and ms_key not in claimed_milestones:
-                    user.balance += ms_reward; claimed_milestones[ms_key] = True; user.claimed_milestones = json.dumps(claimed_milestones)
-                    await ptb_app.bot.send_message(user.id, f"🎉 Milestone Reached! You completed {ms_count} tasks and earned a bonus of ₱{ms_reward:.2f}!")
-            if user.tasks_completed == 1 and user.referrer_id:
-                referrer = db.query(User).filter(User.id == user.referrer_id).with_for_update().first()
-                if referrer: referrer.balance += INVITE_REWARD; referrer.successful_referrals += 1
-                await ptb_app.bot.send_message(user.referrer_id, f"🎉 Your referral {user.first_name} completed their first task! You earned ₱{INVITE_REWARD:.2f}!")
-        db.commit()
+                # Financial/Milestone Logic (Safe due to the per-user locks above; SQLite ignores `with_for_update`)
+                completed_ids = json.loads(user.completed_task_ids)
+                if task.id not in completed_ids:
+                    user.balance += task.reward; user.tasks_completed += 1; completed_ids.append(task.id); user.completed_task_ids = json.dumps(completed_ids)
+                    claimed_milestones = json.loads(user.claimed_milestones)
+                    for ms_key, ms_reward in TASK_MILESTONES.items():
+                        ms_count = int(ms_key.split('_')[0])
+                        if user.tasks_completed == ms_count and ms_key not in claimed_milestones:
+                            user.balance += ms_reward; claimed_milestones[ms_key] = True; user.claimed_milestones = json.dumps(claimed_milestones)
+                            notices.append((user.id, f"🎉 Milestone Reached! You completed {ms_count} tasks and earned a bonus of ₱{ms_reward:.2f}!"))
+                    if user.tasks_completed == 1 and user.referrer_id:
+                        referrer = db.query(User).filter(User.id == user.referrer_id).with_for_update().first()
+                        if referrer: referrer.balance += INVITE_REWARD; referrer.successful_referrals += 1
+                        notices.append((user.referrer_id, f"🎉 Your referral {user.first_name} completed their first task! You earned ₱{INVITE_REWARD:.2f}!"))
+                db.commit()
+        if already_processed: await query.edit_message_caption("Already processed."); return
+        leaderboards.bump("tasks", user.id, user.first_name, user.tasks_completed)
+    for chat_id, notice in notices: await send_notice(chat_id, notice)
     await query.edit_message_caption(caption=f"{query.message.caption.text}\n\n**Status: APPROVED**", parse_mode='Markdown')
-    await ptb_app.bot.send_message(chat_id=user.id, text=f"🎉 Your submission for '{task.description}' was approved! You earned ₱{task.reward:.2f}.")
+    await send_notice(user.id, f"🎉 Your submission for '{task.description}' was approved! You earned ₱{task.reward:.2f}.")
     await review_submissions(update, context) # Show next pending submission
 
 
@@ -717,6 +1071,8 @@ if __name__ == "__main__":
     ptb_app.add_handler(CallbackQueryHandler(admin_stats, pattern="^admin_stats$"))
     ptb_app.add_handler(CallbackQueryHandler(admin_maintenance, pattern="^admin_maintenance$"))
     ptb_app.add_handler(CallbackQueryHandler(toggle_maintenance, pattern=r"^toggle_maintenance_(global|wd)$"))
+    ptb_app.add_handler(CallbackQueryHandler(admin_admission, pattern="^admin_admission$"))
+    ptb_app.add_handler(CallbackQueryHandler(tune_admission, pattern=r"^admission_(read|write|upload)_(limit|queue|deadline)_(inc|dec)$"))
     ptb_app.add_handler(CallbackQueryHandler(admin_manage_tasks, pattern="^admin_manage_tasks$"))
     ptb_app.add_handler(CallbackQueryHandler(toggle_task_status, pattern=r"^toggle_task_\d+$"))
     ptb_app.add_handler(CallbackQueryHandler(review_submissions, pattern="^admin_pending_submissions$"))
@@ -0,0 +1,5 @@
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py creates its SQLite file in the working directory on import.
+os.chdir(tempfile.mkdtemp())
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from main import AdmissionLimiter
+
+
+async def settle():
+    """Lets handed-over waiters wake up through `asyncio.wait_for`."""
+    for _ in range(5): await asyncio.sleep(0)
+
+
+async def queued(limiter, **kwargs):
+    """Starts an `acquire` that has to wait and lets it reach the queue."""
+    task = asyncio.create_task(limiter.acquire(**kwargs))
+    await asyncio.sleep(0)
+    assert not task.done()
+    return task
+
+
+def test_limit_holds_and_queue_overflow_returns_429():
+    async def main():
+        limiter = AdmissionLimiter("write", limit=2, queue=1, deadline=5)
+        await limiter.acquire(); await limiter.acquire()
+        waiting = await queued(limiter)
+        with pytest.raises(HTTPException) as exc: await limiter.acquire()
+        assert exc.value.status_code == 429 and exc.value.headers["Retry-After"] == "6"
+        assert limiter.active == 2 and limiter.shed_count == 1
+        limiter.release(); await waiting
+        assert limiter.active == 2 and not limiter.waiters
+    asyncio.run(main())
+
+
+def test_deadline_expiry_returns_503_and_removes_the_waiter():
+    async def main():
+        limiter = AdmissionLimiter("write", limit=1, queue=5, deadline=0.01)
+        await limiter.acquire()
+        with pytest.raises(HTTPException) as exc: await limiter.acquire()
+        assert exc.value.status_code == 503
+        assert not limiter.waiters and limiter.active == 1
+        limiter.release()
+        assert limiter.active == 0
+    asyncio.run(main())
+
+
+def test_priority_waiters_are_served_first():
+    async def main():
+        limiter = AdmissionLimiter("write", limit=1, queue=5, deadline=5)
+        await limiter.acquire()
+        normal = await queued(limiter)
+        urgent = await queued(limiter, priority=True)
+        limiter.release(); await settle()
+        assert urgent.done() and not normal.done()
+        limiter.release(); await normal
+        assert limiter.active == 1
+    asyncio.run(main())
+
+
+def test_live_configure_drains_on_decrease_and_hands_over_on_increase():
+    async def main():
+        limiter = AdmissionLimiter("write", limit=2, queue=5, deadline=5)
+        await limiter.acquire(); await limiter.acquire()
+        first, second = await queued(limiter), await queued(limiter)
+        limiter.configure(limit=1, queue=5, deadline=5)
+        limiter.release(); await settle()
+        # Over the new limit: the freed slot is dropped, not handed over.
+        assert limiter.active == 1 and not first.done()
+        limiter.configure(limit=3, queue=5, deadline=5); await settle()
+        assert first.done() and second.done() and limiter.active == 3
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_that_was_handed_a_slot_releases_it():
+    async def main():
+        limiter = AdmissionLimiter("write", limit=1, queue=5, deadline=5)
+        await limiter.acquire()
+        waiting = await queued(limiter, shed=False)
+        # Hand the slot over, then cancel before the waiter gets to run.
+        limiter.release(); waiting.cancel()
+        with pytest.raises(asyncio.CancelledError): await waiting
+        assert limiter.active == 0
+        await asyncio.wait_for(limiter.acquire(), 0.1)
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+import asyncio, random
+from unittest.mock import AsyncMock, patch
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from telegram.error import Forbidden
+from telegram.ext import ExtBot
+
+import main
+from main import IdempotencyStore, SessionLocal, User
+
+
+async def send(store, key, work, body_hash="h"):
+    """Mirrors `idempotency_middleware`: the owner runs `work`, duplicates wait and replay."""
+    while True:
+        is_owner, future = store.begin(key, body_hash)
+        if is_owner: break
+        result = await asyncio.shield(future)
+        if result: return result
+    result = None
+    try:
+        result = await work(key)
+        return result
+    finally: store.finish(key, future, result)
+
+
+def retry_storm(store, keys, copies, fail_first=()):
+    executions, running, stats = {}, set(), {"shed": 0, "peak_size": 0}
+
+    async def work(key):
+        assert key not in running, f"{key} executed concurrently"
+        running.add(key)
+        try:
+            await asyncio.sleep(random.random() * 0.005)
+            executions[key] = executions.get(key, 0) + 1
+            if key in fail_first and executions[key] == 1: return None
+            return (200, key.encode(), "application/json")
+        finally: running.discard(key)
+
+    async def client(key):
+        try: result = await send(store, key, work)
+        except HTTPException as e:
+            assert e.status_code == 429; stats["shed"] += 1; return
+        finally: stats["peak_size"] = max(stats["peak_size"], len(store.in_flight) + len(store.stored))
+        if result is None: assert key in fail_first; return # The failed owner sees its own 5xx.
+        assert result == (200, key.encode(), "application/json")
+
+    async def main():
+        requests = [client(f"k{i}") for i in range(keys) for _ in range(copies)]
+        random.shuffle(requests)
+        await asyncio.wait_for(asyncio.gather(*requests), 30)
+
+    asyncio.run(main())
+    return executions, stats
+
+
+def test_retry_storm_runs_each_key_exactly_once():
+    executions, stats = retry_storm(IdempotencyStore(max_keys=10000, ttl=60), keys=500, copies=40)
+    assert len(executions) == 500 and set(executions.values()) == {1}
+    assert stats["shed"] == 0
+
+
+def test_failed_first_attempt_is_rerun_once():
+    failing = {f"k{i}" for i in range(50)}
+    executions, _ = retry_storm(IdempotencyStore(max_keys=10000, ttl=60), keys=500, copies=20, fail_first=failing)
+    assert all(executions[k] == (2 if k in failing else 1) for k in executions)
+
+
+def test_retry_storm_below_capacity_stays_bounded():
+    store = IdempotencyStore(max_keys=50, ttl=60)
+    executions, stats = retry_storm(store, keys=500, copies=20)
+    assert stats["peak_size"] <= 50
+    assert stats["shed"] > 0
+    assert not store.in_flight
+
+
+def test_body_mismatch_is_rejected_in_flight_and_stored():
+    async def main():
+        store = IdempotencyStore(max_keys=10, ttl=60)
+        is_owner, future = store.begin("k", "a")
+        assert is_owner
+        with pytest.raises(HTTPException) as exc: store.begin("k", "b")
+        assert exc.value.status_code == 422
+        store.finish("k", future, (200, b"{}", "application/json"))
+        with pytest.raises(HTTPException) as exc: store.begin("k", "b")
+        assert exc.value.status_code == 422
+        is_owner, future = store.begin("k", "a")
+        assert not is_owner and future.result() == (200, b"{}", "application/json")
+    asyncio.run(main())
+
+
+def test_expired_keys_run_again():
+    async def main():
+        store = IdempotencyStore(max_keys=10, ttl=0.01)
+        _, future = store.begin("k", "a")
+        store.finish("k", future, (200, b"{}", "application/json"))
+        await asyncio.sleep(0.02)
+        is_owner, _ = store.begin("k", "a")
+        assert is_owner and len(store.stored) == 0
+    asyncio.run(main())
+
+
+# --- Through the real middleware stack ---
+
+
+def make_user(user_id, balance=1000.0):
+    with SessionLocal() as db: db.add(User(id=user_id, first_name=f"u{user_id}", balance=balance)); db.commit()
+
+
+def balance_and_tickets(user_id):
+    with SessionLocal() as db:
+        user = db.get(User, user_id)
+        return user.balance, user.gift_tickets
+
+
+def test_committed_request_is_replayed_even_when_telegram_fails():
+    make_user(2701)
+    with patch.object(ExtBot, "send_message", AsyncMock(side_effect=Forbidden("bot was blocked by the user"))):
+        client = TestClient(main.app)
+        responses = [client.post("/buy_ticket", json={"user_id": 2701}, headers={"Idempotency-Key": "abc"}) for _ in range(3)]
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert [r.headers.get("Idempotent-Replayed") for r in responses] == [None, "true", "true"]
+    assert balance_and_tickets(2701) == (1000.0 - main.GIFT_TICKET_PRICE, 2)
+
+
+def test_keys_are_scoped_per_user_and_bound_to_the_body():
+    make_user(2702); make_user(2703)
+    with patch.object(ExtBot, "send_message", AsyncMock()):
+        client = TestClient(main.app)
+        assert client.post("/buy_ticket", json={"user_id": 2702}, headers={"Idempotency-Key": "shared"}).status_code == 200
+        other_user = client.post("/buy_ticket", json={"user_id": 2703}, headers={"Idempotency-Key": "shared"})
+        mismatch = client.post("/buy_ticket", json={"user_id": 2702, "note": "changed"}, headers={"Idempotency-Key": "shared"})
+    assert other_user.status_code == 200 and "Idempotent-Replayed" not in other_user.headers
+    assert mismatch.status_code == 422
+    assert balance_and_tickets(2702) == balance_and_tickets(2703) == (1000.0 - main.GIFT_TICKET_PRICE, 2)
+
+
+def test_requests_shed_by_admission_are_not_stored():
+    make_user(2704)
+    limiter = main.admission_limiters["write"]
+    saved = limiter.settings()
+    with patch.object(ExtBot, "send_message", AsyncMock()):
+        client = TestClient(main.app)
+        limiter.configure(limiter.limit, 0, saved["deadline"]); limiter.active += limiter.limit
+        try: shed = client.post("/buy_ticket", json={"user_id": 2704}, headers={"Idempotency-Key": "k"})
+        finally: limiter.active -= limiter.limit; limiter.configure(**saved)
+        retried = client.post("/buy_ticket", json={"user_id": 2704}, headers={"Idempotency-Key": "k"})
+    assert shed.status_code == 429 and "Retry-After" in shed.headers
+    assert retried.status_code == 200 and "Idempotent-Replayed" not in retried.headers
+    assert balance_and_tickets(2704) == (1000.0 - main.GIFT_TICKET_PRICE, 2)
+
+
+def test_concurrent_duplicates_through_the_app_charge_once():
+    make_user(2705)
+
+    async def storm():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            requests = [client.post("/buy_ticket", json={"user_id": 2705}, headers={"Idempotency-Key": "storm"}) for _ in range(50)]
+            return await asyncio.gather(*requests)
+
+    with patch.object(ExtBot, "send_message", AsyncMock()):
+        responses = asyncio.run(storm())
+    assert all(r.status_code == 200 for r in responses)
+    assert sum("Idempotent-Replayed" not in r.headers for r in responses) == 1
+    assert balance_and_tickets(2705) == (1000.0 - main.GIFT_TICKET_PRICE, 2)
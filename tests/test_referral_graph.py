@@ -0,0 +1,65 @@
+import time
+from unittest.mock import AsyncMock, patch
+
+from fastapi.testclient import TestClient
+from telegram.ext import ExtBot
+
+import main
+from main import GameRoom, Leaderboards, ReferralGraph, SessionLocal, User
+
+
+def test_downline_counts_do_not_depend_on_load_order():
+    edges = [(2, 1), (3, 2), (4, 3), (5, 3), (6, 1)]
+    in_order, reversed_order = ReferralGraph(), ReferralGraph()
+    for user_id, referrer_id in edges: in_order.add_user(user_id, referrer_id)
+    # Children first: every user is loaded before their own referrer.
+    for user_id, referrer_id in reversed(edges): reversed_order.add_user(user_id, referrer_id)
+    for graph in (in_order, reversed_order):
+        assert [graph.downline(u) for u in range(1, 7)] == [5, 3, 2, 0, 0, 0]
+        assert graph.recruits(1) == [2, 6] and graph.recruits(3) == [4, 5] and graph.recruits(4) == []
+
+
+def test_add_user_ignores_repeats_and_stops_at_cycles():
+    graph = ReferralGraph()
+    graph.add_user(2, 1); graph.add_user(2, 1); graph.add_user(3, None)
+    assert graph.downline(1) == 1 and 3 not in graph.parent
+    # referrer_id is only set once at sign-up, but a bad row must not loop forever.
+    graph.add_user(1, 2)
+    assert graph.downline(2) == 2 and graph.downline(1) == 1
+
+
+def test_bump_keeps_only_the_top_n():
+    boards = Leaderboards(size=3)
+    for user_id, value in [(1, 5), (2, 9), (3, 7)]: boards.bump("referrals", user_id, f"u{user_id}", value)
+    boards.bump("referrals", 4, "u4", 1)
+    assert [r["user_id"] for r in boards.boards["referrals"]] == [2, 3, 1]
+    boards.bump("referrals", 4, "u4", 8)
+    assert [r["user_id"] for r in boards.boards["referrals"]] == [2, 4, 3]
+    assert boards.rank("referrals", 4) == 2 and boards.rank("referrals", 1) is None
+    # A user already on the board is moved, not duplicated.
+    boards.bump("referrals", 3, "u3", 10)
+    assert [r["user_id"] for r in boards.boards["referrals"]] == [3, 2, 4]
+
+
+def test_default_win_after_disconnect_reaches_the_winnings_board():
+    with SessionLocal() as db:
+        db.add_all([User(id=2601, first_name="Creator", balance=0.0), User(id=2602, first_name="Opponent", balance=0.0)])
+        room = GameRoom(creator_id=2601, opponent_id=2602, bet_amount=100.0, status='active')
+        db.add(room); db.commit(); room_id = room.id
+
+    with patch.object(ExtBot, "send_message", AsyncMock()):
+        with TestClient(main.app).websocket_connect(f"/ws/{room_id}/2601"): pass
+        for _ in range(100):
+            with SessionLocal() as db:
+                room = db.get(GameRoom, room_id)
+                if room.status == 'cancelled': break
+            time.sleep(0.01)
+
+    prize = 100.0 * 2 * (1 - main.GAME_FEE_PERCENT)
+    with SessionLocal() as db:
+        assert room.status == 'cancelled' and room.winner_id == 2602
+        assert db.get(User, 2602).balance == prize
+        assert main.leaderboards.rank("winnings", 2602) is not None
+        main.leaderboards.refresh(db)
+    entry = next(r for r in main.leaderboards.boards["winnings"] if r["user_id"] == 2602)
+    assert entry["value"] == round(prize, 2) and entry["first_name"] == "Opponent"
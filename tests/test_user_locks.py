@@ -0,0 +1,53 @@
+import asyncio, gc, random
+
+from main import UserLockManager
+
+
+def test_two_party_transfers_are_deadlock_free_and_conserve_balances():
+    locks, balances = UserLockManager(), {user_id: 1000 for user_id in range(6)}
+
+    async def transfer(sender, recipient, amount):
+        async with locks.hold(sender, recipient):
+            sender_balance, recipient_balance = balances[sender], balances[recipient]
+            await asyncio.sleep(0) # Let every other transfer interleave between the read and the write.
+            balances[sender], balances[recipient] = sender_balance - amount, recipient_balance + amount
+
+    async def main():
+        # Both directions of every pair, so naive lock ordering would deadlock.
+        transfers = [transfer(*random.sample(range(6), 2), random.randint(1, 10)) for _ in range(20000)]
+        await asyncio.wait_for(asyncio.gather(*transfers), 30)
+
+    asyncio.run(main())
+    assert sum(balances.values()) == 6000
+    gc.collect()
+    assert len(locks.locks) == 0
+
+
+def test_same_user_is_serialized_and_distinct_users_run_in_parallel():
+    locks, running, peak = UserLockManager(), {}, {}
+    overall = {"running": 0, "peak": 0}
+
+    async def operation(user_id):
+        async with locks.hold(user_id):
+            running[user_id] = running.get(user_id, 0) + 1
+            peak[user_id] = max(peak.get(user_id, 0), running[user_id])
+            overall["running"] += 1; overall["peak"] = max(overall["peak"], overall["running"])
+            await asyncio.sleep(0.01)
+            running[user_id] -= 1; overall["running"] -= 1
+
+    async def main(): await asyncio.gather(*[operation(i % 50) for i in range(200)])
+
+    asyncio.run(main())
+    assert set(peak.values()) == {1}
+    # Every one of the 50 users held its lock at the same time.
+    assert overall["peak"] == 50
+
+
+def test_hold_ignores_missing_and_duplicate_ids():
+    locks = UserLockManager()
+
+    async def main():
+        async with locks.hold(7, None, 7):
+            assert list(locks.locks) == [7] and locks.locks[7].locked()
+
+    asyncio.run(main())